@@ -10,40 +10,35 @@
 # General Public License for more details.
 #
 
-import struct
+import mesh
 
 class STL():
     """
     This class encapsulates reading, modifying, and writing .stl files
-    in both binary and ascii formats
+    in both binary and ascii formats. The work is done by the stateless
+    functions in mesh, this keeps track of the file names and the mesh.
     """
 
-    debug         = False
-    __facets      = []
-    __isBinary    = None
-    __outIsBinary = None
-    __fileComment = ''
-    __readFD      = None
-    __writeFD     = None
-    __header      = None
-    __length      = None
-
     ## __init__
     #
     def __init__(self, infile = None, outfile = None):
-        if infile != None:
-            self.__readFD = open (infile, "rb")
-        if outfile != None:
-            self.__writeFD = open (outfile, "wb")
+        self.debug         = False
+        self.__infile      = infile
+        self.__outfile     = outfile
+        self.__outIsBinary = False
+        self.__info        = None
+        self.__mesh        = mesh.Mesh()
         return
 
     ## setInputFile
     #
     def setInputFile(self, infile):
         """
-        Closes any open input file and open the one requested
+        Use the requested input file
         Resets any meta information associated with the input
         """
+        self.__infile = infile
+        self.__info = None
         return
 
     ## setOutputType
@@ -56,174 +51,30 @@ class STL():
         if type not in ["binary", "ascii"]:
             raise ValueError("Valid output file types are 'ascii' and 'binary'")
         if type == "ascii":
-            self.outIsBinary = False
+            self.__outIsBinary = False
         else:
-            self.outIsBinary = True
+            self.__outIsBinary = True
 
     ## setOutputFile
     #
-    def setOutputFile(self, infile):
+    def setOutputFile(self, outfile):
         """
-        Flushes and closes the output file and open the one requested
-        Resets any meta information associated with the output
+        Use the requested output file
         """
-        if self.__writefd != None:
-            self.__writefd.close()
-            self.__writefd = None
-
-        self.__writedf = open(infile, "wb")
-
+        self.__outfile = outfile
         return
 
-    ## __unpack_float
-    #
-    def __unpack_float(self, count):
-        """
-        Unpack the requested number of floating point values from
-        the input descriptor and return them in an array
-        """
-        data = self.__readFD.read(count*4)
-        formatstr = "<%df" % count
-        return struct.unpack(formatstr, data)
-
-    ## __unpack_attribute
-    #
-    def __unpack_attribute(self):
-        """
-        Unpack a 16 bit attribute from the input descriptor and return it
-        """
-        attr = self.__readFD.read(2)
-        return struct.unpack("<H", attr)[0]
-
-    ## __binary_read_triangle
-    #
-    def __binary_read_triangle(self):
-        """
-        Read the Normal, three vertices, and 2 packing bytes for a triangle in
-        binary stl format, from the input descriptor.
-        Return arrays for each of these items.
-        """
-        n = self.__unpack_float(3)
-        p1 = self.__unpack_float(3)
-        p2 = self.__unpack_float(3)
-        p3 = self.__unpack_float(3)
-        b = self.__unpack_attribute()
-
-        if self.debug:
-            print "Read binary Triangle:"
-            print "  Normal: %f %f %f" % (n[0], n[1], n[2])
-            print "  P1:     %f %f %f" % (p1[0], p1[1], p1[2])
-            print "  P2:     %f %f %f" % (p2[0], p2[1], p2[2])
-            print "  P3:     %f %f %f" % (p3[0], p3[1], p3[2])
-            print "  Attr:   0x%X" % b
-
-        return (n, p1, p2, p3, b)
-
-    ## __read_vertex
+    ## __probe
     #
-    def __read_vertex(self):
+    def __probe(self):
         """
-        Read a 'vertex' line from an ascii input and return the result as a list of three points.
-        Raise an exception for unexpected input or EOF.
+        Gather the type, header and length of the input file, once
         """
-        lparts = self.__readFD.readline().strip().split()
-        if lparts[0] != 'vertex':
-            raise ValueError('Found unexpected line <%s> when expecting vertex' % line)
-        return [float(lparts[1]), float(lparts[2]), float(lparts[3])]
-
-    ## __ascii_read_triangle
-    #
-    def __ascii_read_triangle(self):
-        """
-        Read the Normal, three vertices, and 2 packing bytes for a triangle in
-        ascii stl format, from the input descriptor.
-        Return arrays for each of these items.
-        Exception is raised for end of file.
-        """
-        # ascii data looks like this for a triangle:
-        #
-        # facet normal ni nj nk
-        # outer loop
-        # vertex v1x v1y v1z
-        # vertex v2x v2y v2z
-        # vertex v3x v3y v3z
-        # endloop
-        # endfacet
-        #
-
-        # we're expecting a facet line
-        line = self.__readFD.readline().strip()
-        lparts = line.split()
-        if lparts[0] == 'endsolid':
-            # Same as end of file for our purposes
-            raise EOFError
-        if (lparts[0] != 'facet') or (lparts[1] != 'normal'):
-            raise ValueError('Found unexpected line <%s> when expecting facet' % line)
-        n = [float(lparts[2]), float(lparts[3]), float(lparts[4])]
-
-        # "outer loop"
-        if self.__readFD.readline().strip() != 'outer loop':
-            raise ValueError('Found unexpected line <%s> when expecting outer loop' % line)
-
-        # Now the three vertices
-        p1 = self.__read_vertex()
-        p2 = self.__read_vertex()
-        p3 = self.__read_vertex()
-
-        # "endloop"
-        if self.__readFD.readline().strip() != 'endloop':
-            raise ValueError('Found unexpected line <%s> when expecting endloop' % line)
-
-        # "endfacet"
-        if self.__readFD.readline().strip() != 'endfacet':
-            raise ValueError('Found unexpected line <%s> when expecting endfacet' % line)
-
-        # ascii has no attibute
-        b = 0
-
-        if self.debug:
-            print "Read ascii Triangle:"
-            print "  Normal: %f %f %f" % (n[0], n[1], n[2])
-            print "  P1:     %f %f %f" % (p1[0], p1[1], p1[2])
-            print "  P2:     %f %f %f" % (p2[0], p2[1], p2[2])
-            print "  P3:     %f %f %f" % (p3[0], p3[1], p3[2])
-            print "  Attr:   0x%X" % b
-
-        return (n, p1, p2, p3, b)
-
-    ## __determine_input_type()
-    #
-    def __determine_input_type(self):
-        binflag = False
-        pos = self.__readFD.tell()
-
-        # Try to determine whether this is in binary or ascii format
-        self.__readFD.seek(0)
-
-        # If the first line doesn't start with "solid " it is binary
-        tststr = "solid "
-        solidtest = self.__readFD.read(len(tststr))
-        if solidtest != tststr:
-            binflag = True
-
-        # It could still be binary, as first 80 bytes is comment in a binary file
-        # each facet is 50 bytes, read one and test it to see if it's all ascii
-        self.__readFD.seek(80)
-        facet = self.__readFD.read(50)
-        if not all(ord(c) < 128 for c in facet):
-            binflag = True
-
-        self.__isBinary = binflag
-
-        # if binary, gather some more information depending on type
-        if self.__isBinary:
-            self.__readFD.seek(0)
-            self.__header =  self.__readFD.read(80)
-            tlen = self.__readFD.read(4)
-            self.__length = struct.unpack("<I", tlen)[0]
-
-        self.__readFD.seek(pos)
-        return
+        if self.__info == None:
+            if self.__infile == None:
+                raise ValueError("No input file has been given")
+            self.__info = mesh.probe(self.__infile)
+        return self.__info
 
     ## header
     #
@@ -231,14 +82,7 @@ class STL():
         """
         Return the header if the input file is binary, otherwise return None
         """
-        if self.__isBinary == None:
-            # figure out whether it's binary or ascii
-            self.__determine_input_type()
-
-        if self.__isBinary:
-            return self.__header
-        else:
-            return None
+        return self.__probe()['header']
 
     ## length
     #
@@ -246,14 +90,10 @@ class STL():
         """
         return the number of triangles in the input file, only valid for binary unless we've read the data
         """
-        if self.__isBinary == None:
-            # figure out whether it's binary or ascii
-            self.__determine_input_type()
-
-        if self.__isBinary:
-            return self.__length
-        else:
-            return None
+        info = self.__probe()
+        if info['length'] == None and len(self.__mesh):
+            return len(self.__mesh)
+        return info['length']
 
     ## type
     #
@@ -261,16 +101,33 @@ class STL():
         """
         Return the input file type - "ascii", "binary" or None (if not known)
         """
-        if self.__isBinary == None:
-            # figure out whether it's binary or ascii
-            self.__determine_input_type()
+        return self.__probe()['type']
 
-        if self.__isBinary == None:
-            return None
-        elif self.__isBinary:
-            return "binary"
-        else:
-            return "ascii"
+    ## getMesh
+    #
+    def getMesh(self):
+        """
+        Return a snapshot of the triangle list as a Mesh, which can be shared
+        with other threads or processes. Later calls to addFacet() don't
+        change it.
+        """
+        facets = self.__mesh.facets
+        if isinstance(facets, list):
+            facets = tuple(facets)
+        return mesh.Mesh(facets, self.__mesh.header)
+
+    ## facets
+    #
+    def facets(self):
+        """
+        Return the triangle list as a sequence of (normal, (p1, p2, p3), attribute).
+        If the input file hasn't been read, facets are decoded from it as they
+        are indexed, rather than all at once.
+        """
+        if (len(self.__mesh) == 0) and (self.__infile != None):
+            self.__probe()
+            self.__mesh = mesh.load(self.__infile, lazy = True)
+        return self.__mesh.facets
 
     ## read
     #
@@ -279,39 +136,25 @@ class STL():
         Reads the input file into an internal representation.
         Raises an exception on error
         """
-        if self.__isBinary == None:
-            # figure out whether it's binary or ascii
-            self.__determine_input_type()
+        self.__probe()
+        self.__mesh = mesh.load(self.__infile)
+        if self.debug:
+            self.dump()
+        return
 
-        if self.__isBinary == None:
-            raise ValueError("Unable to determine file type, is this an stl file?")
-        elif self.__isBinary:
-            self.__facets = []
-            # Read all the binary vertices
-            self.__readFD.seek(80)
-            for i in range(self.__length):
-                facet = {}
-                (n, p1, p2, p3, b) =  self.__binary_read_triangle()
-                facet['n'] = n
-                facet['p'] = [p1, p2, p3]
-                facet['a'] = b
-                self.__facets.append(facet)
+    ## write
+    #
+    def write(self):
+        """
+        Writes the internal triangle list to the output file, in the
+        output type
+        """
+        if self.__outfile == None:
+            raise ValueError("No output file has been given")
+        if self.__outIsBinary:
+            mesh.save(self.__mesh, self.__outfile, "binary")
         else:
-            self.__facets = []
-            # read all the ascii vertices
-            self.__readFD.seek(0)
-            line = self.__readFD.readline().strip()
-            if not line.startswith('solid'):
-                raise ValueError('Found unexpected line <%s> when expecting solid' % line)
-            try:
-                while True:
-                    (n, p1, p2, p3, b) =  self.__ascii_read_triangle()
-                    facet['n'] = n
-                    facet['p'] = [p1, p2, p3]
-                    facet['a'] = b
-                    self.__facets.append(facet)
-            except EOFError:
-                pass
+            mesh.save(self.__mesh, self.__outfile, "ascii")
         return
 
     ## addFacet
@@ -320,7 +163,10 @@ class STL():
         """
         Add a facet to the internal list. Normal defaults to all zeros. Attribute defaults to zero
         """
-        self.__facets.append([n, p, a])
+        if not isinstance(self.__mesh.facets, list):
+            # facets read on demand have to be decoded before they can be changed
+            self.__mesh.facets = list(self.__mesh.facets)
+        self.__mesh.facets.append((tuple(n), (tuple(p[0]), tuple(p[1]), tuple(p[2])), a))
         return
 
     ## addFace
@@ -335,18 +181,52 @@ class STL():
      
         return
 
+    ## cleanup
+    #
+    def cleanup(self, tolerance = 0.0):
+        """
+        Remove degenerate and duplicate facets from the internal list,
+        including duplicates wound the other way. Vertices within tolerance
+        of each other are treated as the same. Returns a dict of counts,
+        see mesh.clean()
+        """
+        (self.__mesh, counts) = mesh.clean(self.__mesh, tolerance)
+        if self.debug:
+            print "Cleanup: %(facets)d facets, removed %(degenerate)d degenerate, %(duplicate)d duplicate, %(flipped)d flipped" % counts
+        return counts
+
+    ## writePLY
+    #
+    def writePLY(self, outfile):
+        """
+        Write the internal triangle list to a binary little endian .ply file,
+        sharing vertices between facets
+        """
+        mesh.save(self.__mesh, outfile, "ply")
+        return
+
+    ## writeOBJ
+    #
+    def writeOBJ(self, outfile):
+        """
+        Write the internal triangle list to a wavefront .obj file,
+        sharing vertices between facets
+        """
+        mesh.save(self.__mesh, outfile, "obj")
+        return
+
     ## dump
     #
-    def dump(self):
+    def dump(self, count = None):
         """
-        Dumps the internal tringle list
+        Dumps the internal tringle list, or only the first count facets,
+        which are decoded from the input file on demand if it hasn't been read
         """
-        for facet in self.__facets:
-            n  = facet['n']
-            p1 = facet['p'][0]
-            p2 = facet['p'][1]
-            p3 = facet['p'][2]
-            a  = facet['a']
+        if count == None:
+            facets = self.__mesh.facets
+        else:
+            facets = self.facets()[:count]
+        for (n, (p1, p2, p3), a) in facets:
             print "Facet:"
             print "  Normal: %f %f %f" % (n[0], n[1], n[2])
             print "  P1:     %f %f %f" % (p1[0], p1[1], p1[2])
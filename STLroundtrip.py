@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2012 Steve Conklin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation version 3.
+#
+# This program is distributed "as is" WITHOUT ANY WARRANTY of any kind,
+# whether express or implied; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+
+#
+# Round trip conformance and throughput checks for the stl readers and writers.
+#
+#   STLroundtrip.py [--update-baseline] [unittest options]
+#
+# Randomized files are written by the simple encoders here, independently of
+# mesh.py, then read back by every reader and rewritten by every writer. All
+# results must match bit for bit.
+#
+# Throughput is measured relative to encode_binary() here on the same facets,
+# timed in the same run, so the ratios in roundtrip_baseline.json hold from one
+# machine to the next. A test fails if a ratio drops by more than
+# STL_PERF_MARGIN (default 0.5, so half the baseline), and is skipped if the
+# baseline has no ratio for it. The baseline is only written when
+# --update-baseline is given, which replaces all of the ratios.
+#
+
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+import mesh
+import zmap
+from   STL import STL
+
+baselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "roundtrip_baseline.json")
+updateBaseline = False
+
+## random_facets
+#
+def random_facets(rng, count):
+    """
+    Return count random facets. Values are rounded to 32 bit floats so that
+    they survive a trip through a binary file unchanged.
+    """
+    facets = []
+    for i in xrange(count):
+        v = struct.unpack("<12f", struct.pack("<12f", *[rng.uniform(-1000.0, 1000.0) for j in range(12)]))
+        facets.append((v[0:3], (v[3:6], v[6:9], v[9:12]), rng.randint(0, 0xFFFF)))
+    return facets
+
+## encode_binary
+#
+def encode_binary(facets, header):
+    """
+    Encode facets as a binary stl file, one facet at a time
+    """
+    data = [header.ljust(80, '\0'), struct.pack("<I", len(facets))]
+    for (n, p, a) in facets:
+        data.append(struct.pack("<12fH", *(list(n) + list(p[0]) + list(p[1]) + list(p[2]) + [a])))
+    return "".join(data)
+
+## encode_ascii
+#
+def encode_ascii(facets, name, newline = "\n", indent = "  ", space = " ", layout = "lines"):
+    """
+    Encode facets as an ascii stl file, with a choice of line ending and
+    whitespace. The layout is "lines", the usual seven lines per facet,
+    "words", one word per line, or "packed", three facets per line.
+    """
+    lines = ["solid " + name]
+    packed = []
+    for (n, p, a) in facets:
+        facet = [["facet", "normal"] + [repr(x) for x in n], ["outer", "loop"]]
+        for v in p:
+            facet.append(["vertex"] + [repr(x) for x in v])
+        facet.append(["endloop"])
+        facet.append(["endfacet"])
+        if layout == "lines":
+            depth = [0, 1, 2, 2, 2, 1, 0]
+            lines.extend([indent*d + space.join(words) for (d, words) in zip(depth, facet)])
+        elif layout == "words":
+            lines.extend([indent + word for words in facet for word in words])
+        else:
+            packed.append(space.join([word for words in facet for word in words]))
+            if len(packed) == 3:
+                lines.append(space.join(packed))
+                packed = []
+    if packed:
+        lines.append(space.join(packed))
+    lines.append("endsolid " + name)
+    return newline.join(lines) + newline
+
+## ascii_facets
+#
+def ascii_facets(facets):
+    """
+    Return facets as they read back from an ascii file, which has no attribute
+    """
+    return [(n, p, 0) for (n, p, a) in facets]
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(20120101)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name, data = None):
+        path = os.path.join(self.dir, name)
+        if data != None:
+            with open(path, "wb") as fd:
+                fd.write(data)
+        return path
+
+    def contents(self, path):
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def assertAllReaders(self, path, facets):
+        """
+        Every reader has to return exactly these facets
+        """
+        self.assertEqual(mesh.load(path).facets, facets)
+        self.assertEqual(list(mesh.load(path, lazy = True).facets), facets)
+        # a second lazy load uses the saved ascii index
+        lazy = mesh.load(path, lazy = True).facets
+        self.assertEqual(len(lazy), len(facets))
+        self.assertEqual([lazy[i] for i in range(-1, -len(facets)-1, -1)], facets[::-1])
+        self.assertRaises(IndexError, lambda: lazy[len(facets)])
+        self.assertRaises(IndexError, lambda: lazy[-len(facets)-1])
+        self.assertEqual(lazy[3:len(facets):7], facets[3::7])
+        stl = STL(path)
+        self.assertEqual(len(stl.facets()), len(facets))
+        self.assertEqual(list(stl.facets()), facets)
+        stl = STL(path)
+        stl.read()
+        self.assertEqual(list(stl.getMesh().facets), facets)
+
+    def assertAllWriters(self, facets, header):
+        """
+        Every writer has to produce exactly the reference encoding
+        """
+        m = mesh.Mesh(facets, header)
+        mesh.save(m, self.path("out.stl"), "binary")
+        self.assertEqual(self.contents(self.path("out.stl")), encode_binary(facets, header))
+        mesh.save(m, self.path("out.txt"), "ascii")
+        self.assertEqual(self.contents(self.path("out.txt")), encode_ascii(facets, header))
+
+        stl = STL(outfile = self.path("stlout.stl"))
+        for (n, p, a) in facets:
+            stl.addFacet(p, n, a)
+        stl.setOutputType("binary")
+        stl.write()
+        self.assertEqual(self.contents(self.path("stlout.stl"))[80:], encode_binary(facets, "")[80:])
+        stl.setOutputType("ascii")
+        stl.write()
+        self.assertEqual(self.contents(self.path("stlout.stl")), encode_ascii(facets, ""))
+
+    def test_mesh_snapshot(self):
+        # a mesh handed out by STL is not changed by later additions
+        facets = random_facets(self.rng, 10)
+        stl = STL()
+        for (n, p, a) in facets:
+            stl.addFacet(p, n, a)
+        snapshot = stl.getMesh()
+        stl.addFacet(((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)))
+        self.assertEqual(list(snapshot.facets), facets)
+        self.assertEqual(len(stl.getMesh()), 11)
+
+    def test_binary(self):
+        for count in (0, 1, 255, 256, 257, 1000):
+            facets = random_facets(self.rng, count)
+            path = self.path("b%d.stl" % count, encode_binary(facets, "binary test"))
+            self.assertEqual(mesh.probe(path)['length'], count)
+            self.assertAllReaders(path, facets)
+            self.assertAllWriters(facets, "binary test")
+
+    def test_binary_solid_header(self):
+        # A binary file whose header starts with solid, and whose first
+        # facet is plain ascii, must still be read as binary
+        facets = [((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)), 0x2020)]
+        facets += random_facets(self.rng, 20)
+        path = self.path("solid.stl", encode_binary(facets, "solid pretending to be ascii"))
+        self.assertEqual(mesh.probe(path)['type'], "binary")
+        self.assertAllReaders(path, facets)
+
+    def test_ascii(self):
+        for count in (0, 1, 255, 256, 257, 1000):
+            facets = ascii_facets(random_facets(self.rng, count))
+            path = self.path("a%d.txt" % count, encode_ascii(facets, "ascii test"))
+            self.assertEqual(mesh.probe(path)['type'], "ascii")
+            self.assertAllReaders(path, facets)
+            self.assertAllWriters(facets, "ascii test")
+
+    def test_ascii_layouts(self):
+        # facets several to a line, or split a word to a line, across blocks
+        facets = ascii_facets(random_facets(self.rng, 600))
+        for layout in ("words", "packed"):
+            path = self.path(layout + ".txt", encode_ascii(facets, "layout " + layout, layout = layout))
+            self.assertAllReaders(path, facets)
+            path = self.path(layout + "-crlf.txt", encode_ascii(facets, "facet", newline = "\r\n", space = "\t", layout = layout))
+            self.assertAllReaders(path, facets)
+
+    def test_ascii_crlf(self):
+        facets = ascii_facets(random_facets(self.rng, 300))
+        path = self.path("crlf.txt", encode_ascii(facets, "crlf", newline = "\r\n"))
+        self.assertAllReaders(path, facets)
+
+    def test_ascii_whitespace(self):
+        facets = ascii_facets(random_facets(self.rng, 300))
+        path = self.path("space.txt", encode_ascii(facets, "facet in the name", newline = "\n\n", indent = "\t ", space = " \t "))
+        self.assertEqual(mesh.load(path).header, "facet in the name")
+        self.assertAllReaders(path, facets)
+
+    def test_ascii_index_refresh(self):
+        # A saved index must not be used once the file changes
+        facets = ascii_facets(random_facets(self.rng, 50))
+        path = self.path("changed.txt", encode_ascii(facets, "changed"))
+        self.assertAllReaders(path, facets)
+        facets = ascii_facets(random_facets(self.rng, 80))
+        self.path("changed.txt", encode_ascii(facets, "changed", indent = ""))
+        self.assertAllReaders(path, facets)
+
+    def test_ascii_two_solids(self):
+        # only the first solid is read, by every reader
+        facets = ascii_facets(random_facets(self.rng, 5))
+        data = encode_ascii(facets, "facet name") + encode_ascii(ascii_facets(random_facets(self.rng, 3)), "second")
+        path = self.path("two.txt", data)
+        self.assertAllReaders(path, facets)
+
+    def test_save_over_lazy_source(self):
+        for (fmt, facets) in (("binary", random_facets(self.rng, 300)),
+                              ("ascii", ascii_facets(random_facets(self.rng, 300)))):
+            path = self.path("self.stl")
+            mesh.save(mesh.Mesh(facets, "self"), path, fmt)
+            stl = STL(path, path)
+            stl.setOutputType(fmt)
+            self.assertEqual(stl.facets()[0], facets[0])
+            stl.write()
+            self.assertEqual(mesh.load(path).facets, facets)
+            mesh.save(mesh.load(path, lazy = True), path, fmt)
+            self.assertEqual(mesh.load(path).facets, facets)
+
+    def test_binary_to_ascii_to_binary(self):
+        facets = [(n, p, 0) for (n, p, a) in random_facets(self.rng, 500)]
+        binary = encode_binary(facets, "")
+        mesh.save(mesh.load(self.path("in.stl", binary)), self.path("mid.txt"), "ascii")
+        mesh.save(mesh.load(self.path("mid.txt")), self.path("back.stl"), "binary")
+        self.assertEqual(self.contents(self.path("back.stl")), binary)
+
+    def read_ply(self, path):
+        """
+        Parse a binary little endian ply file as written by mesh.save,
+        returning the vertices and the faces
+        """
+        data = self.contents(path)
+        (header, body) = data.split("end_header\n", 1)
+        lines = header.split("\n")
+        self.assertEqual(lines[0:2], ["ply", "format binary_little_endian 1.0"])
+        nverts = int(lines[2].split()[2])
+        nfaces = int(lines[6].split()[2])
+        self.assertEqual(lines[2:8], ["element vertex %d" % nverts, "property float x",
+                                      "property float y", "property float z",
+                                      "element face %d" % nfaces,
+                                      "property list uchar uint vertex_indices"])
+        self.assertEqual(len(body), nverts*12 + nfaces*13)
+        v = struct.unpack("<%df" % (nverts*3), body[:nverts*12])
+        verts = [v[i:i+3] for i in range(0, len(v), 3)]
+        faces = []
+        for offset in range(nverts*12, len(body), 13):
+            (count, i1, i2, i3) = struct.unpack("<B3I", body[offset:offset+13])
+            self.assertEqual(count, 3)
+            faces.append((i1, i2, i3))
+        return (verts, faces)
+
+    def read_obj(self, path):
+        """
+        Parse the v and f lines of an obj file, returning the vertices, as
+        32 bit floats, and the zero based faces
+        """
+        verts = []
+        faces = []
+        for line in self.contents(path).split("\n"):
+            words = line.split()
+            if words and words[0] == "v":
+                verts.append(struct.unpack("<3f", struct.pack("<3f", *[float(w) for w in words[1:]])))
+            elif words and words[0] == "f":
+                faces.append(tuple([int(w) - 1 for w in words[1:]]))
+        return (verts, faces)
+
+    def test_ply_obj(self):
+        # a quad split along a diagonal shares two of its vertices
+        quad = [((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (1.0, 1.0, 0.0)), 0),
+                ((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 1.0, 0.0), (0.0, 1.0, 0.0)), 0)]
+        for facets in (quad, random_facets(self.rng, 300) + quad):
+            m = mesh.Mesh(facets, "welded")
+            mesh.save(m, self.path("out.ply"), "ply")
+            mesh.save(m, self.path("out.obj"), "obj")
+            for (verts, faces) in (self.read_ply(self.path("out.ply")), self.read_obj(self.path("out.obj"))):
+                self.assertEqual(len(set(verts)), len(verts))
+                self.assertEqual([(verts[i1], verts[i2], verts[i3]) for (i1, i2, i3) in faces],
+                                 [p for (n, p, a) in facets])
+        m = mesh.Mesh(quad, "quad")
+        mesh.save(m, self.path("quad.ply"), "ply")
+        mesh.save(m, self.path("quad.obj"), "obj")
+        for (verts, faces) in (self.read_ply(self.path("quad.ply")), self.read_obj(self.path("quad.obj"))):
+            self.assertEqual(len(verts), 4)
+            self.assertEqual(faces, [(0, 1, 2), (0, 2, 3)])
+
+    def test_truncated_binary(self):
+        facets = random_facets(self.rng, 10)
+        path = self.path("short.stl", encode_binary(facets, "short")[:-20])
+        self.assertRaises(ValueError, mesh.load, path)
+        lazy = mesh.load(path, lazy = True).facets
+        self.assertRaises(ValueError, lambda: lazy[9])
+
+    def test_truncated_ascii(self):
+        facets = ascii_facets(random_facets(self.rng, 10))
+        data = encode_ascii(facets, "short")
+        path = self.path("short.txt", data[:data.rindex("endloop")])
+        self.assertRaises(ValueError, mesh.load, path)
+        lazy = mesh.load(path, lazy = True).facets
+        self.assertEqual(len(lazy), 10)
+        self.assertRaises(ValueError, lambda: lazy[9])
+        self.assertRaises(ValueError, list, lazy)
+        for layout in ("words", "packed"):
+            data = encode_ascii(facets, "short", layout = layout)
+            path = self.path("short-%s.txt" % layout, data[:data.rindex("vertex")])
+            self.assertRaises(ValueError, mesh.load, path)
+            self.assertRaises(ValueError, lambda: mesh.load(path, lazy = True).facets[-1])
+
+    def test_z_table(self):
+        for gamma in (0.5, 1.0, 2.2):
+            zlut = zmap.z_table(0.2, 4.0, gamma)
+            self.assertEqual(len(zlut), 256)
+            self.assertEqual(zlut[0], 4.0)
+            self.assertEqual(zlut[255], 0.2)
+            self.assertEqual(zlut, sorted(zlut, reverse = True))
+        # a straight line curve is the same as a gamma of one
+        linear = zmap.z_table(0.2, 4.0)
+        for (a, b) in zip(zmap.z_table(0.2, 4.0, curve = zmap.parse_curve("0:100,100:0")), linear):
+            self.assertAlmostEqual(a, b)
+        curve = zmap.z_table(0.2, 4.0, curve = zmap.parse_curve("50:20"))
+        self.assertEqual(curve, [0.2 + 0.2*3.8]*256)
+        for bad in ("50:150", "50:-20", "120:50", "-1:50", "50", "a:b", "nan:50"):
+            self.assertRaises(ValueError, zmap.parse_curve, bad)
+
+class CleanupTest(unittest.TestCase):
+
+    def test_clean(self):
+        rng = random.Random(7)
+        facets = random_facets(rng, 200)
+        (n, (p1, p2, p3), a) = facets[0]
+        dirty = list(facets)
+        # exact duplicate, with the vertices rotated
+        dirty.append(((0.0, 0.0, 0.0), (p2, p3, p1), 0))
+        # flipped duplicate
+        dirty.append((n, (p1, p3, p2), a))
+        # repeated vertex, and a zero area sliver
+        dirty.append((n, (p1, p1, p2), a))
+        dirty.append((n, (p1, p2, tuple([2*p2[i] - p1[i] for i in range(3)])), a))
+        # near duplicate
+        near = (n, (p1, p2, (p3[0] + 1e-6, p3[1], p3[2])), a)
+        dirty.append(near)
+
+        (cleaned, counts) = mesh.clean(mesh.Mesh(dirty, "dirty"))
+        self.assertEqual(counts, {'facets' : 205, 'degenerate' : 2, 'duplicate' : 1, 'flipped' : 1, 'kept' : 201})
+        self.assertEqual(cleaned.facets, facets + [near])
+
+        stl = STL()
+        for (n, p, a) in dirty:
+            stl.addFacet(p, n, a)
+        counts = stl.cleanup(tolerance = 1e-3)
+        self.assertEqual(counts['duplicate'], 2)
+        self.assertEqual(list(stl.getMesh().facets), facets)
+
+    def test_clean_cell_boundary(self):
+        # vertices either side of a grid cell boundary, well within tolerance
+        tol = 1e-3
+        a = ((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.4999*tol, 1.0, 0.4999*tol)), 0)
+        b = ((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.5001*tol, 1.0, 0.5001*tol)), 0)
+        c = ((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (0.5001*tol, 1.0, -0.4999*tol), (1.0, 0.0, 0.0)), 0)
+        (cleaned, counts) = mesh.clean(mesh.Mesh([a, b, c]), tol)
+        self.assertEqual(counts, {'facets' : 3, 'degenerate' : 0, 'duplicate' : 1, 'flipped' : 1, 'kept' : 1})
+        self.assertEqual(cleaned.facets, [a])
+        # and not merged beyond the tolerance
+        d = ((0.0, 0.0, 1.0), ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (1.5*tol, 1.0, 0.0)), 0)
+        (cleaned, counts) = mesh.clean(mesh.Mesh([a, d]), tol)
+        self.assertEqual(counts['kept'], 2)
+
+    def test_clean_non_finite(self):
+        facets = random_facets(random.Random(11), 20)
+        (n, (p1, p2, p3), a) = facets[0]
+        nan = float("nan")
+        inf = float("inf")
+        dirty = list(facets)
+        dirty.append((n, (p1, p2, (nan, p3[1], p3[2])), a))
+        dirty.append((n, ((p1[0], inf, p1[2]), p2, p3), a))
+        dirty.append((n, (p1, (p2[0], p2[1], -inf), p3), a))
+        dirty.append((n, ((nan, nan, nan), (inf, inf, inf), (-inf, nan, inf)), a))
+        for tol in (0.0, 1e-3):
+            (cleaned, counts) = mesh.clean(mesh.Mesh(dirty), tol)
+            self.assertEqual(counts, {'facets' : 24, 'degenerate' : 4, 'duplicate' : 0, 'flipped' : 0, 'kept' : 20})
+            self.assertEqual(cleaned.facets, facets)
+
+        stl = STL()
+        for (n, p, a) in dirty:
+            stl.addFacet(p, n, a)
+        self.assertEqual(stl.cleanup(tolerance = 1e-3)['degenerate'], 4)
+        self.assertEqual(list(stl.getMesh().facets), facets)
+
+class ThroughputTest(unittest.TestCase):
+
+    count = 50000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.facets = random_facets(random.Random(1), cls.count)
+        cls.ratios = {}
+        cls.baseline = {}
+        if os.path.exists(baselineFile):
+            with open(baselineFile, "rb") as fd:
+                cls.baseline = json.load(fd)
+        # the reference workload every rate is divided by
+        cls.reference = cls.rate(lambda: encode_binary(cls.facets, "reference"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+        if updateBaseline:
+            with open(baselineFile, "wb") as fd:
+                json.dump(cls.ratios, fd, indent = 4, sort_keys = True)
+                fd.write("\n")
+
+    @classmethod
+    def rate(cls, func):
+        """
+        Return the best rate in facets/s of func, which handles cls.count facets
+        """
+        best = None
+        for i in range(3):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if (best == None) or (elapsed < best):
+                best = elapsed
+        return cls.count / max(best, 1e-9)
+
+    def assertRate(self, name, func):
+        """
+        Time func against the reference workload, and fail if the ratio has
+        fallen too far below the baseline. Returns False if there's no
+        baseline ratio to compare with.
+        """
+        ratio = self.rate(func) / self.reference
+        self.ratios[name] = ratio
+        if updateBaseline or (name not in self.baseline):
+            return False
+
+        margin = float(os.environ.get("STL_PERF_MARGIN", "0.5"))
+        floor = self.baseline[name] * (1.0 - margin)
+        self.assertTrue(ratio >= floor, "%s: %.2f times the reference rate is below %.2f (baseline %.2f)" %
+                        (name, ratio, floor, self.baseline[name]))
+        return True
+
+    def test_rates(self):
+        m = mesh.Mesh(self.facets, "throughput")
+        binary = os.path.join(self.dir, "t.stl")
+        ascii = os.path.join(self.dir, "t.txt")
+        checks = [
+            ("save binary", lambda: mesh.save(m, binary, "binary")),
+            ("save ascii", lambda: mesh.save(m, ascii, "ascii")),
+            ("save ply", lambda: mesh.save(m, os.path.join(self.dir, "t.ply"), "ply")),
+            ("save obj", lambda: mesh.save(m, os.path.join(self.dir, "t.obj"), "obj")),
+            ("load binary", lambda: mesh.load(binary)),
+            ("load ascii", lambda: mesh.load(ascii)),
+            ("lazy binary", lambda: list(mesh.load(binary, lazy = True).facets)),
+            ("lazy ascii", lambda: list(mesh.load(ascii, lazy = True).facets)),
+            ("clean", lambda: mesh.clean(m, 1e-3)),
+            ]
+        # run them all before skipping, so a regression isn't hidden
+        missing = [name for (name, func) in checks if not self.assertRate(name, func)]
+        if updateBaseline:
+            self.skipTest("recording a new baseline in %s" % baselineFile)
+        if missing:
+            self.skipTest("no baseline in %s for %s, run with --update-baseline to record one" %
+                          (baselineFile, ", ".join(missing)))
+
+if __name__ == '__main__':
+    if "--update-baseline" in sys.argv:
+        sys.argv.remove("--update-baseline")
+        updateBaseline = True
+    unittest.main()
@@ -29,8 +29,12 @@ def main():
             print "Header:"
             print stl.header()
 
-        stl.read()
-        stl.dump()
+        if len(argv) > 2:
+            # Only decode the facets we're going to show
+            stl.dump(int(argv[2]))
+        else:
+            stl.read()
+            stl.dump()
 
     except Exception, e:
         print e
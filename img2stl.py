@@ -13,8 +13,10 @@
 #
 
 from   STL            import STL
+import zmap
 import os
 import Image
+import ImageFilter
 from   ImageChops     import invert
 from   ImageOps       import expand
 
@@ -30,12 +32,24 @@ from getopt           import getopt, GetoptError
 # --invert-thickness
 # --twotone (only two levels)
 # --threshhold=
+# --resample=nearest|bilinear|bicubic|antialias
+# --blur=<radius>
+# --sharpen
+# --gamma=
+# --curve=b:t,b:t,...
 #
 # By default, thickest is darkest
 
 
 class IMG2STL():
 
+    resample_filters = {
+        'nearest'   : Image.NEAREST,
+        'bilinear'  : Image.BILINEAR,
+        'bicubic'   : Image.BICUBIC,
+        'antialias' : Image.ANTIALIAS,
+    }
+
     def __init__(self):
         self.debug = False
         # Sizes are in mm
@@ -50,6 +64,12 @@ class IMG2STL():
         self.invert = False
         self.twotone = False
         self.threshhold = None
+        self.resample = 'nearest'
+        self.blur = 0.0
+        self.sharpen = False
+        self.gamma = 1.0
+        self.curve = None
+        self.zlut = None
         self.infile = ""
         self.outfile = ""
         self.inputImage = None
@@ -73,6 +93,11 @@ class IMG2STL():
         print "        --invert-thickness               Make darkest parts of the image the thinnest output \n",
         print "        --twotone                        Only make two output levels                         \n",
         print "        --threshhold=<%>                 The image brighness % for twotone                   \n",
+        print "        --resample=<filter>              nearest, bilinear, bicubic or antialias             \n",
+        print "        --blur=<radius>                  Gaussian blur the image before thresholding         \n",
+        print "        --sharpen                        Sharpen the image before thresholding               \n",
+        print "        --gamma=<gamma>                  Gamma applied to brightness when mapping thickness  \n",
+        print "        --curve=<b:t,b:t,...>            Brightness % to thickness % curve, for lithophanes  \n",
         print "                                                                                             \n",
         print "    Examples:                                                                                \n",
         print "        %s infile.bmp outfile.stl                                                            \n" % argv[0],
@@ -85,13 +110,21 @@ class IMG2STL():
             print "Displaying image in separate window"
             self.inputImage.show()
 
+    def build_z_table(self):
+        """
+        Build the 256 entry lookup table of Z values from the gamma or curve
+        """
+        self.zlut = zmap.z_table(self.thinnest, self.thickest, self.gamma, self.curve)
+        return
+
     def z_val(self, pixel_value):
         """
-        Scale the Z value, so that the darkest part of the image is the thickest
-        and the lightest part is the thinnest
+        Return the Z value for a single pixel
         """
-        result = self.thickest - (float(pixel_value)*(self.thickest-self.thinnest))/255.0
-        return result
+        if self.zlut == None:
+            self.build_z_table()
+        return self.zlut[pixel_value]
+
     
     def convert_for_output(self):
         in_x_pixels = self.inputImage.size[0]
@@ -121,20 +154,34 @@ class IMG2STL():
 
             if self.debug:
                 print "  Resizing to %dx%d pixels" % (newxsize, newysize)
-            self.inputImage = self.inputImage.resize((newxsize,newysize))
+            self.inputImage = self.inputImage.resize((newxsize,newysize), self.resample_filters[self.resample])
+
+        # Change to grayscale if needed, filters and thresholding work on that
+        if self.inputImage.mode != "L":
+            if self.debug:
+                print "  Converting to grayscale"
+            self.inputImage = self.inputImage.convert("L")
+
+        if self.blur > 0:
+            if self.debug:
+                print "  Blurring with radius ", self.blur
+            self.inputImage = self.inputImage.filter(ImageFilter.GaussianBlur(self.blur))
+
+        if self.sharpen:
+            if self.debug:
+                print "  Sharpening"
+            self.inputImage = self.inputImage.filter(ImageFilter.SHARPEN)
 
         if self.twotone:
-            # We want a bicolor interpretation
-            if self.inputImage.mode != "1":
-                if self.debug:
-                    print "  Converting to bicolor"
-                self.inputImage = self.inputImage.convert("1")
-        else:
-            # Change to grayscale if needed
-            if self.inputImage.mode != "L":
-                if self.debug:
-                    print "  Converting to grayscale"
-                self.inputImage = self.inputImage.convert("L")
+            # We want a bicolor interpretation, split at the threshhold
+            threshhold = self.threshhold
+            if threshhold == None:
+                threshhold = 50
+            cutoff = (threshhold*255)/100
+            if self.debug:
+                print "  Converting to bicolor at level ", cutoff
+            table = [0]*cutoff + [255]*(256-cutoff)
+            self.inputImage = self.inputImage.point(table)
 
         if self.border > 0:
             if self.debug:
@@ -168,7 +215,7 @@ class IMG2STL():
         # if there's a border, then the side faces are all the same height
         if self.border > 0:
             # Create left side face
-            self.stl.addFace([[Xorigin,Ymax,0],[Xorigin,Ymax,pix[0,0]],[Xorigin,Yorigin,pix[0,maxInY], [Xorigin,Yorigin,0]])
+            self.stl.addFace([[Xorigin,Ymax,0],[Xorigin,Ymax,self.z_val(pix[0,0])],[Xorigin,Yorigin,self.z_val(pix[0,maxInY-1])], [Xorigin,Yorigin,0]])
             #self.stl.addFacet([[x,y,0],[x,y,z],[x,y,z]])
             # Create right side face
             # Create bottom side face
@@ -178,18 +225,21 @@ class IMG2STL():
             # Create right side face
             # Create bottom side face
             # Create top side face
+            pass
     
 
         #addFacet(self, p, n=[0.0,0.0,0.0], a=0):
 
         # Walk through all pixels except the outside perimeter, adding triangles
+        # with Z from self.z_val(pix[x,y]), a lookup in the table built once
         return
 
     def process_command_line(self):
         try:
             pname = os.path.basename(argv[0])
             optsShort = ''
-            optsLong  = ['help', 'geometry=', 'thickest=', 'thinnest=', 'border=', 'invert-thickness', 'twotone', 'threshhold=', 'binary-stl']
+            optsLong  = ['help', 'geometry=', 'thickest=', 'thinnest=', 'border=', 'invert-thickness', 'twotone', 'threshhold=', 'binary-stl',
+                          'resample=', 'blur=', 'sharpen', 'gamma=', 'curve=']
             opts, args = getopt(argv[1:], optsShort, optsLong)
 
             for opt, val in opts:
@@ -232,6 +282,26 @@ class IMG2STL():
                         raise ValueError("Invalid specification of --threshhold parameter (should be an int between 1 and 99)")
                 elif opt in ('--binary-stl'):
                     self.outputType = 'binary'
+                elif opt in ('--resample'):
+                    if val not in self.resample_filters:
+                        raise ValueError("Invalid specification of --resample parameter (should be one of %s)" % ", ".join(sorted(self.resample_filters)))
+                    self.resample = val
+                elif opt in ('--blur'):
+                    try:
+                        self.blur = float(val)
+                    except:
+                        raise ValueError("Invalid specification of --blur parameter (should be a float)")
+                elif opt in ('--sharpen'):
+                    self.sharpen = True
+                elif opt in ('--gamma'):
+                    try:
+                        self.gamma = float(val)
+                    except:
+                        raise ValueError("Invalid specification of --gamma parameter (should be a float)")
+                    if self.gamma <= 0:
+                        raise ValueError("Invalid specification of --gamma parameter (should be greater than zero)")
+                elif opt in ('--curve'):
+                    self.curve = zmap.parse_curve(val)
 
             if len(args) < 2:
                 raise ValueError("You must supply input and output file names")
@@ -0,0 +1,690 @@
+# Copyright (C) 2012 Steve Conklin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation version 3.
+#
+# This program is distributed "as is" WITHOUT ANY WARRANTY of any kind,
+# whether express or implied; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+
+#
+# Stateless reading and writing of triangle meshes. Nothing here keeps
+# a file open or holds module level state, so any number of threads or
+# processes can load, save and share meshes at the same time.
+#
+
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from array       import array
+from collections import OrderedDict
+
+# A binary facet is a normal, three vertices and a 16 bit attribute
+_record = struct.Struct("<12fH")
+
+# Number of records packed or formatted per bulk write
+_blockFacets = 4096
+
+# Saved ascii facet index, the file size and mtime it was built from,
+# the size of each offset and the number of offsets
+_indexMagic  = "STLX"
+_indexHeader = struct.Struct("<4sQQII")
+
+# the words facet and endsolid, split on whitespace the way
+# _parse_ascii_facets() splits them, so endfacet doesn't match
+_facetWord    = re.compile(r"(?<!\S)facet(?!\S)")
+_endsolidWord = re.compile(r"(?<!\S)endsolid(?!\S)")
+
+_asciiFacet = ("facet normal %r %r %r\n"
+               "  outer loop\n"
+               "    vertex %r %r %r\n"
+               "    vertex %r %r %r\n"
+               "    vertex %r %r %r\n"
+               "  endloop\n"
+               "endfacet\n")
+
+class Mesh():
+    """
+    A list of triangles and the header they were read with.
+    Each facet is a (normal, (p1, p2, p3), attribute) tuple. Facets are
+    never changed in place, so a mesh can be pickled, or shared between
+    threads, without copying.
+    """
+
+    ## __init__
+    #
+    def __init__(self, facets = None, header = None):
+        if facets == None:
+            facets = []
+        self.facets = facets
+        self.header = header
+        return
+
+    ## __len__
+    #
+    def __len__(self):
+        return len(self.facets)
+
+## _is_binary
+#
+def _is_binary(start, size):
+    """
+    Decide from the first 134 bytes of a file, and its size, whether it is a
+    binary stl file
+    """
+    # A binary file is exactly the size its facet count says, whatever
+    # its header says
+    if len(start) >= 84:
+        count = struct.unpack("<I", start[80:84])[0]
+        if size == 84 + 50*count:
+            return True
+
+    # If the first line doesn't start with "solid" it is binary
+    if not start.startswith("solid"):
+        return True
+
+    # It could still be binary, as first 80 bytes is comment in a binary file
+    # each facet is 50 bytes, test one to see if it's all ascii
+    if not all(ord(c) < 128 for c in start[80:130]):
+        return True
+
+    return False
+
+## probe
+#
+def probe(path):
+    """
+    Return a dict describing an stl file without reading its facets.
+    'type' is "binary" or "ascii", 'header' and 'length' are the binary
+    header and facet count, or None for ascii files.
+    """
+    with open(path, "rb") as fd:
+        start = fd.read(134)
+        fd.seek(0, 2)
+        size = fd.tell()
+
+    if _is_binary(start, size):
+        if len(start) < 84:
+            raise ValueError("File is too short to be a binary stl file")
+        return {'type'   : "binary",
+                'header' : start[:80],
+                'length' : struct.unpack("<I", start[80:84])[0]}
+    else:
+        return {'type'   : "ascii",
+                'header' : None,
+                'length' : None}
+
+## _read_binary
+#
+def _read_binary(data, length):
+    """
+    Unpack length facets from the data following a binary header
+    """
+    if len(data) < length*50:
+        raise ValueError("File is truncated, expected %d facets but found %d" % (length, len(data)/50))
+
+    facets = []
+    unpack = _record.unpack_from
+    for offset in xrange(0, length*50, 50):
+        r = unpack(data, offset)
+        facets.append((r[0:3], (r[3:6], r[6:9], r[9:12]), r[12]))
+    return facets
+
+## _read_ascii
+#
+def _read_ascii(data):
+    """
+    Parse ascii stl data, returning the solid name and the facets
+    """
+    # ascii data looks like this for a triangle:
+    #
+    # facet normal ni nj nk
+    # outer loop
+    # vertex v1x v1y v1z
+    # vertex v2x v2y v2z
+    # vertex v3x v3y v3z
+    # endloop
+    # endfacet
+    #
+    lines = data.split("\n", 1)
+    line = lines[0].strip()
+    if not line.startswith('solid'):
+        raise ValueError('Found unexpected line <%s> when expecting solid' % line)
+    name = line[5:].strip()
+
+    if len(lines) > 1:
+        facets = _parse_ascii_facets(lines[1])
+    else:
+        facets = []
+
+    return (name, facets)
+
+## _parse_ascii_facets
+#
+def _parse_ascii_facets(data):
+    """
+    Parse the facets in a run of ascii stl data, up to endsolid or the end
+    of the data. A facet is always 21 words, however it is spread over lines.
+    """
+    words = data.split()
+    facets = []
+    i = 0
+    nwords = len(words)
+    # A missing endsolid is treated the same as end of file
+    while i < nwords and words[i] != 'endsolid':
+        w = words[i:i+21]
+        if len(w) < 21:
+            raise ValueError("File is truncated, found a partial facet <%s>" % " ".join(w))
+        if ((w[0] != 'facet') or (w[1] != 'normal') or (w[5] != 'outer') or (w[6] != 'loop') or
+            (w[7] != 'vertex') or (w[11] != 'vertex') or (w[15] != 'vertex') or
+            (w[19] != 'endloop') or (w[20] != 'endfacet')):
+            raise ValueError('Found unexpected facet <%s>' % " ".join(w))
+        n  = (float(w[2]), float(w[3]), float(w[4]))
+        p1 = (float(w[8]), float(w[9]), float(w[10]))
+        p2 = (float(w[12]), float(w[13]), float(w[14]))
+        p3 = (float(w[16]), float(w[17]), float(w[18]))
+        # ascii has no attibute
+        facets.append((n, (p1, p2, p3), 0))
+        i += 21
+
+    return facets
+
+class LazyFacets():
+    """
+    A read only sequence of the facets in an stl file, decoded a block at a
+    time as they are indexed, with the most recently used blocks cached.
+    Binary facets are found by seeking to 84 + 50*i. Ascii facets are found
+    through an index of facet offsets, built on first use and saved next to
+    the stl file so later opens can use it directly.
+    """
+
+    ## __init__
+    #
+    def __init__(self, path, info = None, blockSize = 256, cacheBlocks = 16):
+        if info == None:
+            info = probe(path)
+        self.path        = path
+        self.type        = info['type']
+        self.blockSize   = blockSize
+        self.cacheBlocks = cacheBlocks
+        self.__length    = info['length']
+        self.__offsets   = None
+        self.__cache     = OrderedDict()
+        self.__lock      = threading.RLock()
+        return
+
+    ## __getstate__
+    #
+    def __getstate__(self):
+        """
+        Pickle everything but the cache and its lock
+        """
+        state = self.__dict__.copy()
+        state['_LazyFacets__cache'] = OrderedDict()
+        del state['_LazyFacets__lock']
+        return state
+
+    ## __setstate__
+    #
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+        return
+
+    ## __len__
+    #
+    def __len__(self):
+        if self.__length == None:
+            with self.__lock:
+                if self.__length == None:
+                    self.__load_index()
+        return self.__length
+
+    ## __getitem__
+    #
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        length = len(self)
+        if i < 0:
+            i += length
+        if (i < 0) or (i >= length):
+            raise IndexError("facet index out of range")
+        (block, pos) = divmod(i, self.blockSize)
+        return self.__block(block)[pos]
+
+    ## __iter__
+    #
+    def __iter__(self):
+        for block in xrange((len(self) + self.blockSize - 1) / self.blockSize):
+            for facet in self.__block(block):
+                yield facet
+
+    ## __block
+    #
+    def __block(self, block):
+        """
+        Return the list of facets in a block, from the cache if possible
+        """
+        with self.__lock:
+            facets = self.__cache.pop(block, None)
+            if facets == None:
+                facets = self.__decode_block(block)
+            self.__cache[block] = facets
+            while len(self.__cache) > self.cacheBlocks:
+                self.__cache.popitem(last = False)
+        return facets
+
+    ## __decode_block
+    #
+    def __decode_block(self, block):
+        """
+        Read and decode the facets in a block from the file
+        """
+        first = block*self.blockSize
+        count = min(self.blockSize, len(self) - first)
+        with open(self.path, "rb") as fd:
+            if self.type == "binary":
+                fd.seek(84 + 50*first)
+                return _read_binary(fd.read(50*count), count)
+            else:
+                fd.seek(self.__offsets[first])
+                if first + count < self.__length:
+                    data = fd.read(self.__offsets[first + count] - self.__offsets[first])
+                else:
+                    data = fd.read()
+                facets = _parse_ascii_facets(data)
+                if len(facets) != count:
+                    raise ValueError("Found %d facets at facet %d where the index has %d" % (len(facets), first, count))
+                return facets
+
+    ## __load_index
+    #
+    def __load_index(self):
+        """
+        Load the ascii facet offsets from the saved index if it is still
+        current, otherwise build the index and save it
+        """
+        st = os.stat(self.path)
+        stamp = (st.st_size, int(st.st_mtime*1000000))
+        offsets = array('L')
+        indexpath = self.path + ".idx"
+        try:
+            with open(indexpath, "rb") as fd:
+                (magic, size, mtime, itemsize, count) = _indexHeader.unpack(fd.read(_indexHeader.size))
+                if (magic == _indexMagic) and ((size, mtime) == stamp) and (itemsize == offsets.itemsize):
+                    offsets.fromfile(fd, count)
+                    self.__offsets = offsets
+        except (IOError, EOFError, struct.error):
+            pass
+
+        if self.__offsets == None:
+            offsets = self.__build_index()
+            # Saving the index is only an optimization, so a read only
+            # directory is not an error
+            try:
+                (tmpfd, tmppath) = tempfile.mkstemp(prefix = os.path.basename(indexpath) + ".",
+                                                    dir = os.path.dirname(os.path.abspath(indexpath)))
+                with os.fdopen(tmpfd, "wb") as fd:
+                    fd.write(_indexHeader.pack(_indexMagic, stamp[0], stamp[1], offsets.itemsize, len(offsets)))
+                    offsets.tofile(fd)
+                os.rename(tmppath, indexpath)
+            except (IOError, OSError):
+                pass
+            self.__offsets = offsets
+
+        self.__length = len(self.__offsets)
+        return
+
+    ## __build_index
+    #
+    def __build_index(self):
+        """
+        Scan an ascii file for the offset of every facet word, wherever it
+        is on a line, up to the first endsolid, the same facets
+        _parse_ascii_facets() reads
+        """
+        offsets = array('L')
+        with open(self.path, "rb") as fd:
+            # skip the solid line, the name might contain the word facet
+            start = len(fd.readline())
+            data = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                end = _endsolidWord.search(data, start)
+                if end == None:
+                    end = len(data)
+                else:
+                    end = end.start()
+                offsets.extend([m.start() for m in _facetWord.finditer(data, start, end)])
+            finally:
+                data.close()
+        return offsets
+
+## load
+#
+def load(path, lazy = False):
+    """
+    Read an stl file in either format and return it as a Mesh.
+    If lazy is set the facets are a LazyFacets sequence, which only decodes
+    the facets that are asked for.
+    """
+    info = probe(path)
+    with open(path, "rb") as fd:
+        if lazy:
+            if info['type'] == "binary":
+                header = info['header']
+            else:
+                header = fd.readline().strip()[5:].strip()
+            facets = LazyFacets(path, info)
+        elif info['type'] == "binary":
+            fd.seek(84)
+            header = info['header']
+            facets = _read_binary(fd.read(), info['length'])
+        else:
+            (header, facets) = _read_ascii(fd.read())
+    return Mesh(facets, header)
+
+## _write_binary
+#
+def _write_binary(fd, mesh):
+    """
+    Write a mesh as a binary stl file, a block of facets at a time
+    """
+    header = mesh.header
+    if header == None:
+        header = ''
+    facets = mesh.facets
+    nfacets = len(facets)
+    fd.write(header[:80].ljust(80, '\0'))
+    fd.write(struct.pack("<I", nfacets))
+
+    for start in xrange(0, nfacets, _blockFacets):
+        block = facets[start:start+_blockFacets]
+        record = []
+        for (n, p, a) in block:
+            record.extend(n)
+            record.extend(p[0])
+            record.extend(p[1])
+            record.extend(p[2])
+            record.append(a)
+        fd.write(struct.pack("<" + "12fH"*len(block), *record))
+    return
+
+## _write_ascii
+#
+def _write_ascii(fd, mesh):
+    """
+    Write a mesh as an ascii stl file, a block of facets at a time.
+    Values are written with repr so they read back exactly.
+    """
+    name = mesh.header
+    if name == None:
+        name = ''
+    name = " ".join(name.split('\0')[0].split())
+    facets = mesh.facets
+    nfacets = len(facets)
+    fd.write("solid %s\n" % name)
+
+    for start in xrange(0, nfacets, _blockFacets):
+        block = facets[start:start+_blockFacets]
+        record = []
+        for (n, p, a) in block:
+            record.extend(n)
+            record.extend(p[0])
+            record.extend(p[1])
+            record.extend(p[2])
+        fd.write((_asciiFacet * len(block)) % tuple(map(float, record)))
+
+    fd.write("endsolid %s\n" % name)
+    return
+
+## _weld_vertices
+#
+def _weld_vertices(mesh):
+    """
+    Merge identical vertices shared between facets, hashing each vertex as
+    its packed 12 byte little endian float form. Return the vertex block,
+    those packed vertices in index order, and a flat array of vertex
+    indices, three per facet.
+    """
+    index = {}
+    setdefault = index.setdefault
+    faces = array('I')
+    facets = mesh.facets
+    for start in xrange(0, len(facets), _blockFacets):
+        coords = []
+        for (n, p, a) in facets[start:start+_blockFacets]:
+            coords.extend(p[0])
+            coords.extend(p[1])
+            coords.extend(p[2])
+        packed = struct.pack("<%df" % len(coords), *coords)
+        # a new vertex gets the next index, as len(index) is taken before it is added
+        faces.extend([setdefault(packed[i:i+12], len(index)) for i in xrange(0, len(packed), 12)])
+
+    verts = [None] * len(index)
+    for (key, vi) in index.iteritems():
+        verts[vi] = key
+    return ("".join(verts), faces)
+
+## _write_ply
+#
+def _write_ply(fd, mesh):
+    """
+    Write a mesh as a binary little endian .ply file, sharing vertices
+    between facets
+    """
+    (verts, faces) = _weld_vertices(mesh)
+    nverts = len(verts) / 12
+    nfaces = len(faces) / 3
+
+    fd.write("ply\n")
+    fd.write("format binary_little_endian 1.0\n")
+    fd.write("element vertex %d\n" % nverts)
+    fd.write("property float x\n")
+    fd.write("property float y\n")
+    fd.write("property float z\n")
+    fd.write("element face %d\n" % nfaces)
+    fd.write("property list uchar uint vertex_indices\n")
+    fd.write("end_header\n")
+
+    # The vertex block is already packed little endian floats
+    fd.write(verts)
+
+    # Each face is a count byte followed by three indices, packed
+    # a block of faces at a time
+    if sys.byteorder != 'little':
+        faces.byteswap()
+    for start in xrange(0, nfaces, _blockFacets):
+        count = min(_blockFacets, nfaces - start)
+        packed = faces[start*3:(start+count)*3].tostring()
+        fd.write("".join(["\x03" + packed[i:i+12] for i in xrange(0, len(packed), 12)]))
+    return
+
+## _write_obj
+#
+def _write_obj(fd, mesh):
+    """
+    Write a mesh as a wavefront .obj file, sharing vertices between facets
+    """
+    (verts, faces) = _weld_vertices(mesh)
+    nverts = len(verts) / 12
+    nfaces = len(faces) / 3
+
+    fd.write("# %d vertices, %d faces\n" % (nverts, nfaces))
+
+    # Format a block of lines at a time, obj indices are one based
+    for start in xrange(0, nverts, _blockFacets):
+        count = min(_blockFacets, nverts - start)
+        values = struct.unpack("<%df" % (count*3), verts[start*12:(start+count)*12])
+        fd.write(("v %.9g %.9g %.9g\n" * count) % values)
+
+    for start in xrange(0, nfaces, _blockFacets):
+        count = min(_blockFacets, nfaces - start)
+        fd.write(("f %d %d %d\n" * count) % tuple([i+1 for i in faces[start*3:(start+count)*3]]))
+    return
+
+## clean
+#
+def clean(mesh, tolerance = 0.0):
+    """
+    Return a copy of a mesh without degenerate or duplicate facets, and a
+    dict counting the 'facets' examined, and the 'degenerate', 'duplicate',
+    'flipped' (the same triangle wound the other way) and 'kept' facets.
+
+    Vertices are welded first, so that every vertex closer than tolerance
+    on each axis to one already seen takes its id. Each facet is then hashed
+    on its vertex ids, rotated to start at the smallest so the winding is
+    kept. Both steps are hash lookups, one pass however large the mesh.
+    With a tolerance, triangles narrower than it also count as degenerate,
+    and so do facets with a NaN or infinite coordinate, which can't be welded.
+    """
+    counts = {'facets' : 0, 'degenerate' : 0, 'duplicate' : 0, 'flipped' : 0, 'kept' : 0}
+    weld = _VertexWeld(tolerance)
+    seen = set()
+    facets = []
+    for facet in mesh.facets:
+        counts['facets'] += 1
+        (n, (p1, p2, p3), a) = facet
+        # x - x is only 0.0 if x is finite
+        if ((p1[0]-p1[0]) + (p1[1]-p1[1]) + (p1[2]-p1[2]) +
+            (p2[0]-p2[0]) + (p2[1]-p2[1]) + (p2[2]-p2[2]) +
+            (p3[0]-p3[0]) + (p3[1]-p3[1]) + (p3[2]-p3[2])) != 0.0:
+            counts['degenerate'] += 1
+            continue
+
+        k1 = weld.id(p1)
+        k2 = weld.id(p2)
+        k3 = weld.id(p3)
+
+        if (k1 == k2) or (k2 == k3) or (k3 == k1) or (_height(p1, p2, p3) <= tolerance):
+            counts['degenerate'] += 1
+            continue
+
+        # rotate the smallest vertex to the front, keeping the winding
+        if (k1 < k2) and (k1 < k3):
+            key = (k1, k2, k3)
+            flipped = (k1, k3, k2)
+        elif k2 < k3:
+            key = (k2, k3, k1)
+            flipped = (k2, k1, k3)
+        else:
+            key = (k3, k1, k2)
+            flipped = (k3, k2, k1)
+
+        if key in seen:
+            counts['duplicate'] += 1
+        elif flipped in seen:
+            counts['flipped'] += 1
+        else:
+            seen.add(key)
+            facets.append(facet)
+
+    counts['kept'] = len(facets)
+    return (Mesh(facets, mesh.header), counts)
+
+class _VertexWeld():
+    """
+    Give vertices ids, the same id for vertices closer than tolerance to
+    each other on every axis. Vertices are kept in a grid of cells twice the
+    tolerance wide, so a match can only be in a vertex's own cell or the
+    neighbour on the nearer side of each axis, eight cells in all, and
+    matches across a cell boundary are still found.
+    """
+
+    ## __init__
+    #
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.__ids     = {}
+        self.__cells   = {}
+        self.__count   = 0
+        if tolerance > 0:
+            self.__scale = 0.5 / tolerance
+        return
+
+    ## id
+    #
+    def id(self, v):
+        v = (v[0], v[1], v[2])
+        vi = self.__ids.get(v)
+        if vi != None:
+            return vi
+
+        vi = self.__count
+        tol = self.tolerance
+        if tol > 0:
+            (x, y, z) = v
+            (fx, fy, fz) = (x*self.__scale, y*self.__scale, z*self.__scale)
+            (cx, cy, cz) = (int(round(fx)), int(round(fy)), int(round(fz)))
+            # the neighbouring cell on the nearer side of each axis
+            if fx < cx:
+                nx = cx - 1
+            else:
+                nx = cx + 1
+            if fy < cy:
+                ny = cy - 1
+            else:
+                ny = cy + 1
+            if fz < cz:
+                nz = cz - 1
+            else:
+                nz = cz + 1
+            get = self.__cells.get
+            for cell in ((cx, cy, cz), (cx, cy, nz), (cx, ny, cz), (cx, ny, nz),
+                         (nx, cy, cz), (nx, cy, nz), (nx, ny, cz), (nx, ny, nz)):
+                for (w, wi) in get(cell, ()):
+                    if (abs(w[0]-x) < tol) and (abs(w[1]-y) < tol) and (abs(w[2]-z) < tol):
+                        self.__ids[v] = wi
+                        return wi
+            self.__cells.setdefault((cx, cy, cz), []).append((v, vi))
+        self.__ids[v] = vi
+        self.__count += 1
+        return vi
+
+## _height
+#
+def _height(p1, p2, p3):
+    """
+    Return the smallest height of a triangle, twice its area over its
+    longest edge, or 0.0 if it has no area
+    """
+    (ux, uy, uz) = (p2[0]-p1[0], p2[1]-p1[1], p2[2]-p1[2])
+    (vx, vy, vz) = (p3[0]-p1[0], p3[1]-p1[1], p3[2]-p1[2])
+    (wx, wy, wz) = (p3[0]-p2[0], p3[1]-p2[1], p3[2]-p2[2])
+    (cx, cy, cz) = (uy*vz - uz*vy, uz*vx - ux*vz, ux*vy - uy*vx)
+    area2 = cx*cx + cy*cy + cz*cz
+    if area2 == 0.0:
+        return 0.0
+    longest = max(ux*ux + uy*uy + uz*uz, vx*vx + vy*vy + vz*vz, wx*wx + wy*wy + wz*wz)
+    return (area2 / longest) ** 0.5
+
+_writers = {
+    'binary' : _write_binary,
+    'ascii'  : _write_ascii,
+    'ply'    : _write_ply,
+    'obj'    : _write_obj,
+}
+
+## save
+#
+def save(mesh, path, fmt = "binary"):
+    """
+    Write a mesh to path. Valid formats are "binary" and "ascii" stl,
+    "ply" and "obj"
+    """
+    if fmt not in _writers:
+        raise ValueError("Valid output formats are %s" % ", ".join(["'%s'" % f for f in sorted(_writers)]))
+    if isinstance(mesh.facets, LazyFacets) and os.path.exists(path) and os.path.samefile(mesh.facets.path, path):
+        # opening the file for writing would truncate the facets before
+        # they are read, so decode them all first
+        mesh = Mesh(list(mesh.facets), mesh.header)
+    with open(path, "wb") as fd:
+        _writers[fmt](fd, mesh)
+    return
@@ -0,0 +1,70 @@
+# Copyright (C) 2012 Steve Conklin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation version 3.
+#
+# This program is distributed "as is" WITHOUT ANY WARRANTY of any kind,
+# whether express or implied; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+
+#
+# Mapping of image brightness to output thickness, kept apart from img2stl
+# so it doesn't need PIL
+#
+
+## parse_curve
+#
+def parse_curve(val):
+    """
+    Parse a brightness% to thickness% curve given as "b:t,b:t,...", and return
+    it as a list of (brightness 0-255, thickness fraction 0.0-1.0) points.
+    Raise ValueError if it's malformed or a percentage is outside 0-100.
+    """
+    curve = []
+    try:
+        for point in val.split(','):
+            (b, t) = point.split(':')
+            curve.append((float(b), float(t)))
+    except ValueError:
+        raise ValueError("Invalid specification of --curve parameter (should be brightness%:thickness% pairs)")
+
+    for (b, t) in curve:
+        if not ((0 <= b <= 100) and (0 <= t <= 100)):
+            raise ValueError("Invalid specification of --curve parameter (percentages should be between 0 and 100)")
+
+    return [(b*255.0/100.0, t/100.0) for (b, t) in curve]
+
+## z_table
+#
+def z_table(thinnest, thickest, gamma = 1.0, curve = None):
+    """
+    Return a 256 entry lookup table of Z values, so that the darkest part of
+    the image is the thickest and the lightest part is the thinnest.
+    Brightness is passed through the gamma, or the curve if one is given.
+    """
+    if curve != None:
+        # piecewise linear between the (brightness, thickness) points
+        points = sorted(curve)
+        if points[0][0] > 0:
+            points.insert(0, (0.0, points[0][1]))
+        if points[-1][0] < 255:
+            points.append((255.0, points[-1][1]))
+        fractions = []
+        seg = 0
+        for v in range(256):
+            while v > points[seg+1][0]:
+                seg += 1
+            (b0, t0) = points[seg]
+            (b1, t1) = points[seg+1]
+            if b1 == b0:
+                fractions.append(t1)
+            else:
+                fractions.append(t0 + (t1-t0)*(v-b0)/(b1-b0))
+    else:
+        # thickness falls as brightness rises
+        fractions = [1.0 - (v/255.0)**gamma for v in range(256)]
+
+    return [thinnest + f*(thickest-thinnest) for f in fractions]